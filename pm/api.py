@@ -1,31 +1,235 @@
-from fastapi import FastAPI, Header, HTTPException
+from fastapi import BackgroundTasks, FastAPI, Header, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+import json
+import logging
+import math
+import orjson
+import queue
+import random
+import secrets
 import sqlite3
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import os
 from datetime import datetime, timezone
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 DB_PATH = os.getenv("DB_PATH", "edge_machine.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
 POLYMARKET_GAMMA = "https://gamma-api.polymarket.com"
+HTTP_TIMEOUT_SECS = float(os.getenv("HTTP_TIMEOUT_SECS", "8"))
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "16"))
+HTTP_ATTEMPTS = int(os.getenv("HTTP_ATTEMPTS", "3"))
+JOB_TIME_BUDGET_SECS = float(os.getenv("JOB_TIME_BUDGET_SECS", "60"))
+DISCOVER_PAGES = int(os.getenv("DISCOVER_PAGES", "1"))
+PRICE_CACHE_TTL_SECS = float(os.getenv("PRICE_CACHE_TTL_SECS", "5"))
+DETAIL_CACHE_TTL_SECS = float(os.getenv("DETAIL_CACHE_TTL_SECS", "60"))
 
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "edge-machine-admin-2026")
+ADMIN_TOKEN_B = ADMIN_TOKEN.encode("utf-8")
+
+log = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pool and schema are set up once per server process, not on import
+    init_db()
+    yield
+
 
 app = FastAPI(
     title="Edge Machine API",
-    version="1.6.4"
+    lifespan=lifespan,
+    version="1.6.4",
+    default_response_class=ORJSONResponse,
 )
 
 # -----------------------
 # DB helpers
 # -----------------------
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+def connect(path: str, read_only: bool = False) -> sqlite3.Connection:
+    # IMMEDIATE: `with conn:` blocks take the write lock up front
+    conn = sqlite3.connect(
+        path,
+        check_same_thread=False,
+        isolation_level="IMMEDIATE",
+        cached_statements=256,
+    )
     conn.row_factory = sqlite3.Row
+    # Per-connection settings; journal_mode=WAL is set once in init_db
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
     return conn
 
 
+class SQLitePool:
+    """
+    Fixed-size pool of long-lived read-only connections.
+    Keeps SQLite's page cache warm instead of reopening the file per call.
+    """
+
+    def __init__(self, path: str, size: int):
+        self._conns: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._conns.put(connect(path, read_only=True))
+
+    def get(self) -> sqlite3.Connection:
+        return self._conns.get()
+
+    def put(self, conn: sqlite3.Connection):
+        self._conns.put(conn)
+
+
+POOL: Optional[SQLitePool] = None
+
+# SQLite allows one writer at a time; queue writers here rather than
+# in SQLite's busy handler. WAL readers in POOL are never blocked.
+WRITER: Optional[sqlite3.Connection] = None
+WRITE_LOCK = threading.Lock()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    gamma_market_id TEXT,
+    yes_token_id TEXT,
+    latest_pm_p REAL,
+    latest_machine_p REAL,
+    created_at TEXT NOT NULL,
+    detail_etag TEXT
+);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    job_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    started_at TEXT NOT NULL,
+    finished_at TEXT
+);
+"""
+
+# Columns added to SCHEMA after it first shipped; CREATE TABLE IF NOT
+# EXISTS leaves existing tables alone, so those get them on boot
+MIGRATIONS = [
+    ("detail_etag", "ALTER TABLE events ADD COLUMN detail_etag TEXT"),
+]
+
+INDEXES = """
+-- /v1/events: ORDER BY created_at DESC LIMIT ? becomes an index walk
+CREATE INDEX IF NOT EXISTS ix_events_created
+    ON events(created_at DESC);
+
+-- hydrate_tokens: only rows still missing a token
+CREATE INDEX IF NOT EXISTS ix_events_hydrate
+    ON events(id, gamma_market_id) WHERE yes_token_id IS NULL;
+
+-- update_prices: covering, only rows with a token
+CREATE INDEX IF NOT EXISTS ix_events_token
+    ON events(id, yes_token_id) WHERE yes_token_id IS NOT NULL;
+
+-- forecast_machine: only rows with a crowd price
+CREATE INDEX IF NOT EXISTS ix_events_pm
+    ON events(id) WHERE latest_pm_p IS NOT NULL;
+"""
+
+
+def init_db():
+    global POOL, WRITER
+    if POOL is not None:
+        return
+    WRITER = connect(DB_PATH)
+
+    with get_writer() as db:
+        # Persistent in the database file, so one connection is enough
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+
+        cols = {r["name"] for r in db.execute("PRAGMA table_info(events)")}
+        missing = [ddl for col, ddl in MIGRATIONS if col not in cols]
+        if missing:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for ddl in missing:
+                    db.execute(ddl)
+
+        db.executescript(INDEXES)
+
+        # Fresh planner statistics for the partial indexes on every boot;
+        # analysis_limit samples each index so this stays cheap as it grows
+        db.execute("PRAGMA analysis_limit=1000")
+        db.execute("ANALYZE")
+
+        # Single-process service: a job still 'running' at boot died with
+        # the previous process, so close it instead of leaving pollers hanging
+        stale = db.execute(
+            "SELECT id, job_name FROM jobs WHERE status='running'"
+        ).fetchall()
+        finished = now_utc()
+        closed = [
+            (
+                json.dumps({
+                    "ok": False,
+                    "job": r["job_name"],
+                    "error": "interrupted by restart",
+                }),
+                finished,
+                r["id"],
+            )
+            for r in stale
+        ]
+        with db:
+            db.executemany(
+                "UPDATE jobs SET status='failed', result=?, finished_at=? WHERE id=?",
+                closed,
+            )
+
+    # Readers open after the schema exists
+    POOL = SQLitePool(DB_PATH, DB_POOL_SIZE)
+
+
+@contextmanager
+def get_db():
+    conn = POOL.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        POOL.put(conn)
+
+
+@contextmanager
+def get_writer():
+    with WRITE_LOCK:
+        try:
+            yield WRITER
+        finally:
+            if WRITER.in_transaction:
+                WRITER.rollback()
+
+
+def fetch_tuples(db: sqlite3.Connection, sql: str, params=()) -> list:
+    # Plain tuples for job scans; the pool's sqlite3.Row stays the default
+    cur = db.cursor()
+    cur.row_factory = None
+    return cur.execute(sql, params).fetchall()
+
+
 def now_utc():
     return datetime.now(timezone.utc).isoformat()
 
@@ -47,8 +251,9 @@ class EventOut(BaseModel):
 # Health
 # -----------------------
 
+# No I/O here, so it runs on the event loop instead of the threadpool
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True, "time": now_utc()}
 
 
@@ -56,144 +261,495 @@ def health():
 # Events
 # -----------------------
 
-@app.get("/v1/events", response_model=List[EventOut])
-def list_events(limit: int = 50):
-    db = get_db()
-    rows = db.execute(
-        """
-        SELECT id, title, gamma_market_id,
-               latest_pm_p, latest_machine_p, created_at
-        FROM events
-        ORDER BY created_at DESC
-        LIMIT ?
-        """,
-        (limit,),
-    ).fetchall()
-    return [dict(r) for r in rows]
+# Rows are already typed by the schema, so they go straight to orjson;
+# EventOut only documents the shape in OpenAPI.
+@app.get("/v1/events", responses={200: {"model": List[EventOut]}})
+def list_events(limit: int = Query(default=50, ge=1, le=500)):
+    with get_db() as db:
+        cur = db.execute(
+            """
+            SELECT id, title, gamma_market_id,
+                   latest_pm_p, latest_machine_p, created_at
+            FROM events
+            ORDER BY created_at DESC
+            LIMIT ?
+            """,
+            (limit,),
+        )
+        events = [dict(r) for r in cur]
+    return ORJSONResponse(events)
 
 
 # -----------------------
 # Admin job runner
 # -----------------------
 
+def check_admin(x_admin_token: Optional[str]):
+    # Constant-time compare against the token encoded once at import
+    if not x_admin_token or not secrets.compare_digest(
+        x_admin_token.encode("utf-8"), ADMIN_TOKEN_B
+    ):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+def execute_job(job_id: str, job_name: str):
+    """
+    Runs in the background after the request has returned.
+    Outcome is recorded on the jobs row for polling.
+    """
+    try:
+        result, status = JOBS[job_name](), "done"
+    except Exception as e:
+        # Only str(e) reaches the jobs row; keep the traceback in the logs
+        log.exception("job %s (%s) failed", job_name, job_id)
+        result, status = {"ok": False, "job": job_name, "error": str(e)}, "failed"
+
+    with get_writer() as db:
+        with db:
+            db.execute(
+                "UPDATE jobs SET status=?, result=?, finished_at=? WHERE id=?",
+                (status, json.dumps(result), now_utc(), job_id),
+            )
+
+
 @app.post("/v1/admin/jobs/run")
 def run_job(
     job_name: str,
+    background: BackgroundTasks,
     x_admin_token: Optional[str] = Header(default=None),
 ):
-    if x_admin_token != ADMIN_TOKEN:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+    check_admin(x_admin_token)
 
-    if job_name == "discover_markets":
-        return discover_markets()
-    if job_name == "hydrate_tokens":
-        return hydrate_tokens()
-    if job_name == "update_prices":
-        return update_prices()
-    if job_name == "forecast_machine":
-        return forecast_machine()
+    if job_name not in JOBS:
+        raise HTTPException(status_code=400, detail="Unknown job")
 
-    raise HTTPException(status_code=400, detail="Unknown job")
+    job_id = secrets.token_hex(8)
+    with get_writer() as db:
+        with db:
+            db.execute(
+                """
+                INSERT INTO jobs (id, job_name, status, started_at)
+                VALUES (?, ?, 'running', ?)
+                """,
+                (job_id, job_name, now_utc()),
+            )
+
+    background.add_task(execute_job, job_id, job_name)
+    return {"ok": True, "job": job_name, "job_id": job_id}
+
+
+@app.get("/v1/admin/jobs/{job_id}")
+def get_job(
+    job_id: str,
+    x_admin_token: Optional[str] = Header(default=None),
+):
+    check_admin(x_admin_token)
+
+    with get_db() as db:
+        row = db.execute(
+            """
+            SELECT id, job_name, status, result, started_at, finished_at
+            FROM jobs WHERE id=?
+            """,
+            (job_id,),
+        ).fetchone()
+
+    if row is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+@app.post("/v1/admin/cache/clear")
+def clear_caches(x_admin_token: Optional[str] = Header(default=None)):
+    check_admin(x_admin_token)
+
+    # Report what the caches held before the flush
+    cleared = {"price": PRICE_CACHE.stats(), "detail": DETAIL_CACHE.stats()}
+    PRICE_CACHE.clear()
+    DETAIL_CACHE.clear()
+    return {"ok": True, "cleared": cleared}
 
 
 # -----------------------
-# Jobs
+# Caches
 # -----------------------
 
-def discover_markets(limit: int = 50):
-    r = requests.get(f"{POLYMARKET_GAMMA}/markets?limit={limit}")
-    r.raise_for_status()
-    markets = r.json()
+class TTLCache:
+    """
+    Thread-safe TTL + LRU map for upstream responses.
+    get() returns None on a miss or an expired entry. hits/misses only
+    ever grow, so a job can diff two counts() snapshots around its run.
+    """
 
-    db = get_db()
-    inserted = 0
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def counts(self) -> Tuple[int, int]:
+        with self._lock:
+            return self.hits, self.misses
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+PRICE_CACHE = TTLCache(ttl=PRICE_CACHE_TTL_SECS, maxsize=512)
+DETAIL_CACHE = TTLCache(ttl=DETAIL_CACHE_TTL_SECS, maxsize=2048)
+
+
+def cache_delta(cache: TTLCache, hits: int, misses: int) -> dict:
+    # Lookups since a counts() snapshot; a job that runs alongside
+    # another job on the same cache also sees that job's lookups
+    now_hits, now_misses = cache.counts()
+    return {"hits": now_hits - hits, "misses": now_misses - misses}
 
-    for m in markets:
-        db.execute(
-            """
-            INSERT OR IGNORE INTO events
-            (id, title, gamma_market_id, created_at)
-            VALUES (?, ?, ?, ?)
-            """,
-            (
-                str(m["id"]),
-                m["question"],
-                str(m["id"]),
-                now_utc(),
-            ),
-        )
-        inserted += 1
 
-    db.commit()
-    return {"ok": True, "job": "discover_markets", "inserted": inserted}
+# -----------------------
+# Upstream helpers
+# -----------------------
 
+# One keep-alive session for every Gamma call, sized to the fan-out so
+# worker threads reuse sockets instead of paying TCP+TLS per request.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=max(HTTP_WORKERS, 32),
+        max_retries=0,  # retries are handled by gamma_get()
+    ),
+)
+SESSION.headers["Connection"] = "keep-alive"
 
-def hydrate_tokens():
-    db = get_db()
-    rows = db.execute(
-        "SELECT id, gamma_market_id FROM events WHERE yes_token_id IS NULL"
-    ).fetchall()
 
-    attempted = 0
-    hydrated = 0
+def backoff(attempt: int, base: float = 0.2, cap: float = 4.0) -> float:
+    # Full jitter: concurrent workers don't retry in lockstep
+    return random.uniform(0, min(cap, base * 2 ** attempt))
 
-    for r in rows:
-        attempted += 1
-        market_id = r["gamma_market_id"]
 
-        resp = requests.get(f"{POLYMARKET_GAMMA}/markets/{market_id}")
-        if resp.status_code != 200:
+def gamma_get(
+    path: str,
+    params: Optional[dict] = None,
+    deadline: Optional[float] = None,
+    headers: Optional[dict] = None,
+) -> requests.Response:
+    """
+    GET against Gamma, retrying only timeouts, connection errors, 429 and
+    5xx with backoff(); no retry would sleep past `deadline` (a
+    time.monotonic() value). Other 4xx is returned to the caller at once.
+    """
+    attempt = 0
+    while True:
+        err = None
+        try:
+            r = SESSION.get(
+                f"{POLYMARKET_GAMMA}{path}",
+                params=params,
+                headers=headers,
+                timeout=HTTP_TIMEOUT_SECS,
+            )
+            if r.status_code < 500 and r.status_code != 429:
+                return r
+        except (requests.Timeout, requests.ConnectionError) as e:
+            err = e
+
+        attempt += 1
+        delay = backoff(attempt)
+        out_of_time = deadline is not None and time.monotonic() + delay > deadline
+        if attempt >= HTTP_ATTEMPTS or out_of_time:
+            if err is not None:
+                raise err
+            return r
+        time.sleep(delay)
+
+
+def gamma_get_markets(limit: int, offset: int = 0) -> list:
+    r = gamma_get("/markets", params={"limit": limit, "offset": offset})
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+def gamma_get_detail(
+    market_id: str,
+    deadline: Optional[float] = None,
+    etag: Optional[str] = None,
+) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    (payload, ETag) for a market. payload is None on errors and on
+    304 Not Modified when `etag` is sent as If-None-Match.
+    """
+    cached = DETAIL_CACHE.get(market_id)
+    if cached is not None:
+        return cached
+
+    headers = {"If-None-Match": etag} if etag else None
+    try:
+        r = gamma_get(f"/markets/{market_id}", deadline=deadline, headers=headers)
+    except requests.RequestException:
+        return None, None
+    if r.status_code != 200:
+        return None, None
+
+    result = orjson.loads(r.content), r.headers.get("ETag")
+    DETAIL_CACHE.set(market_id, result)
+    return result
+
+
+def gamma_get_price(
+    token_id: str, deadline: Optional[float] = None
+) -> Optional[float]:
+    cached = PRICE_CACHE.get(token_id)
+    if cached is not None:
+        return cached
+
+    try:
+        r = gamma_get(f"/token/{token_id}", deadline=deadline)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+    price = orjson.loads(r.content).get("price")
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        return None
+    # min/max would turn NaN into 1.0; bad prices skip this row instead
+    if not math.isfinite(price):
+        return None
+
+    price = max(0.0, min(1.0, price))
+    PRICE_CACHE.set(token_id, price)
+    return price
+
+
+_ROOT_YES_KEYS = ("yesTokenId", "yes_token_id")
+_TOKEN_ID_KEYS = ("token_id", "tokenId", "id", "clobTokenId")
+_YES_LABELS = frozenset({"yes", "true"})
+
+
+def _as_list(v) -> list:
+    # Gamma ships some list fields as JSON-encoded strings
+    if isinstance(v, str):
+        try:
+            v = orjson.loads(v)
+        except orjson.JSONDecodeError:
+            return []
+    return v if isinstance(v, list) else []
+
+
+def extract_yes_token_id(data: dict) -> Optional[str]:
+    """
+    YES token id from a Gamma market payload, or None.
+    Tries a flat key, then one pass over (label, token) pairs taken from
+    tokens[] or from the parallel outcomes / clobTokenIds lists.
+    """
+    for k in _ROOT_YES_KEYS:
+        v = data.get(k)
+        if v:
+            return str(v)
+
+    tokens = _as_list(data.get("tokens"))
+    if tokens:
+        labels = [t.get("outcome") if isinstance(t, dict) else None for t in tokens]
+    else:
+        labels = _as_list(data.get("outcomes"))
+        tokens = _as_list(data.get("clobTokenIds"))
+
+    for label, tok in zip(labels, tokens):
+        if not isinstance(label, str) or label.strip().casefold() not in _YES_LABELS:
             continue
+        if isinstance(tok, dict):
+            for k in _TOKEN_ID_KEYS:
+                v = tok.get(k)
+                if v:
+                    return str(v)
+        elif tok:
+            return str(tok)
 
-        data = resp.json()
-        yes_token = next(
-            (t["id"] for t in data.get("tokens", []) if t["outcome"] == "Yes"),
-            None,
-        )
+    return None
 
-        if yes_token:
-            db.execute(
-                "UPDATE events SET yes_token_id=? WHERE id=?",
-                (yes_token, r["id"]),
-            )
-            hydrated += 1
 
-    db.commit()
-    return {
-        "ok": True,
-        "job": "hydrate_tokens",
-        "attempted": attempted,
-        "hydrated": hydrated,
-    }
+def fan_out(
+    fn, items: list, deadline: Optional[float] = None, default=None
+) -> list:
+    """
+    Run fn over items concurrently; results keep the input order.
+    The jobs are network-bound, so threads overlap the round-trips.
+    Calls not finished by `deadline` (time.monotonic()) are dropped:
+    queued ones never start and their slot holds `default`.
+    """
+    if not items:
+        return []
+    ex = ThreadPoolExecutor(max_workers=min(HTTP_WORKERS, len(items)))
+    try:
+        futs = [ex.submit(fn, item) for item in items]
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        wait(futs, timeout=timeout)
+    finally:
+        # Stragglers finish in the background; they only warm the caches
+        ex.shutdown(wait=False, cancel_futures=True)
+    return [f.result() if f.done() and not f.cancelled() else default for f in futs]
 
 
-def update_prices():
-    db = get_db()
-    rows = db.execute(
-        "SELECT id, yes_token_id FROM events WHERE yes_token_id IS NOT NULL"
-    ).fetchall()
+# -----------------------
+# Jobs
+# -----------------------
+
+# Fixed statement text so each pooled connection's statement cache hits
+SQL_UPSERT_EVENT = """
+INSERT INTO events (id, title, gamma_market_id, created_at)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET title = excluded.title
+"""
+SQL_COUNT_EVENTS = "SELECT COUNT(*) FROM events"
+SQL_SELECT_UNHYDRATED = """
+SELECT id, gamma_market_id, detail_etag FROM events
+WHERE yes_token_id IS NULL
+"""
+SQL_SET_YES_TOKEN = "UPDATE events SET yes_token_id=? WHERE id=?"
+SQL_SET_DETAIL_ETAG = "UPDATE events SET detail_etag=? WHERE id=?"
+SQL_SELECT_TOKENS = (
+    "SELECT id, yes_token_id FROM events WHERE yes_token_id IS NOT NULL"
+)
+SQL_SET_PM_P = "UPDATE events SET latest_pm_p=? WHERE id=?"
+SQL_FORECAST = """
+UPDATE events SET latest_machine_p = latest_pm_p
+WHERE latest_pm_p IS NOT NULL
+"""
+
 
-    updated = 0
+def discover_markets(limit: int = 50):
+    # Pages are fetched concurrently; a failed page fails the job
+    pages = fan_out(
+        lambda offset: gamma_get_markets(limit, offset),
+        [i * limit for i in range(max(DISCOVER_PAGES, 1))],
+    )
+
+    # One timestamp per run: the batch shares a discovery time.
+    # Markets without a question would fail title NOT NULL and roll
+    # back the whole batch, so they are skipped here.
+    now = now_utc()
+    rows = [
+        (str(m["id"]), m["question"], str(m["id"]), now)
+        for page in pages
+        for m in page
+        if m.get("question")
+    ]
+
+    # rowcount also counts conflict updates; the row count delta under
+    # the write lock is the number of new markets
+    with get_writer() as db:
+        with db:
+            before = db.execute(SQL_COUNT_EVENTS).fetchone()[0]
+            db.executemany(SQL_UPSERT_EVENT, rows)
+            inserted = db.execute(SQL_COUNT_EVENTS).fetchone()[0] - before
+    return {"ok": True, "job": "discover_markets", "inserted": inserted}
 
-    for r in rows:
-        token_id = r["yes_token_id"]
 
-        resp = requests.get(f"{POLYMARKET_GAMMA}/token/{token_id}")
-        if resp.status_code != 200:
+def hydrate_tokens():
+    with get_db() as db:
+        rows = fetch_tuples(db, SQL_SELECT_UNHYDRATED)
+
+    # Markets that had no YES token last time are re-asked conditionally;
+    # an unchanged payload comes back as a body-less 304
+    deadline = time.monotonic() + JOB_TIME_BUDGET_SECS
+    hits, misses = DETAIL_CACHE.counts()
+    details = fan_out(
+        lambda row: gamma_get_detail(row[1], deadline, etag=row[2]),
+        rows,
+        deadline=deadline,
+        default=(None, None),
+    )
+    cache = cache_delta(DETAIL_CACHE, hits, misses)
+
+    hydrated = []
+    etags = []
+
+    for (event_id, _, old_etag), (data, etag) in zip(rows, details):
+        if data is None:
             continue
 
-        data = resp.json()
-        price = data.get("price")
+        yes_token = extract_yes_token_id(data)
+        if yes_token:
+            hydrated.append((yes_token, event_id))
+        elif etag and etag != old_etag:
+            etags.append((etag, event_id))
+
+    with get_writer() as db:
+        with db:
+            db.executemany(SQL_SET_YES_TOKEN, hydrated)
+            db.executemany(SQL_SET_DETAIL_ETAG, etags)
+    return {
+        "ok": True,
+        "job": "hydrate_tokens",
+        "attempted": len(rows),
+        "hydrated": len(hydrated),
+        "cache": cache,
+    }
 
-        if price is not None:
-            db.execute(
-                "UPDATE events SET latest_pm_p=? WHERE id=?",
-                (float(price), r["id"]),
-            )
-            updated += 1
 
-    db.commit()
-    return {"ok": True, "job": "update_prices", "updated": updated}
+def update_prices():
+    with get_db() as db:
+        rows = fetch_tuples(db, SQL_SELECT_TOKENS)
+
+    deadline = time.monotonic() + JOB_TIME_BUDGET_SECS
+    hits, misses = PRICE_CACHE.counts()
+    prices = fan_out(
+        lambda tid: gamma_get_price(tid, deadline),
+        [tid for _, tid in rows],
+        deadline=deadline,
+    )
+    cache = cache_delta(PRICE_CACHE, hits, misses)
+
+    updates = [
+        (price, event_id)
+        for (event_id, _), price in zip(rows, prices)
+        if price is not None
+    ]
+
+    with get_writer() as db:
+        with db:
+            db.executemany(SQL_SET_PM_P, updates)
+    return {
+        "ok": True,
+        "job": "update_prices",
+        "updated": len(updates),
+        "cache": cache,
+    }
 
 
 def forecast_machine():
@@ -203,19 +759,15 @@ def forecast_machine():
     This exists so the pipeline is complete.
     You can swap this later with real models.
     """
-    db = get_db()
-    rows = db.execute(
-        "SELECT id, latest_pm_p FROM events WHERE latest_pm_p IS NOT NULL"
-    ).fetchall()
-
-    updated = 0
-
-    for r in rows:
-        db.execute(
-            "UPDATE events SET latest_machine_p=? WHERE id=?",
-            (r["latest_pm_p"], r["id"]),
-        )
-        updated += 1
-
-    db.commit()
-    return {"ok": True, "job": "forecast_machine", "updated": updated}
\ No newline at end of file
+    with get_writer() as db:
+        with db:
+            cur = db.execute(SQL_FORECAST)
+    return {"ok": True, "job": "forecast_machine", "updated": cur.rowcount}
+
+
+JOBS = {
+    "discover_markets": discover_markets,
+    "hydrate_tokens": hydrate_tokens,
+    "update_prices": update_prices,
+    "forecast_machine": forecast_machine,
+}
\ No newline at end of file
@@ -6,6 +6,8 @@ import sys
 API = os.getenv("PM_API_BASE", "http://localhost:8000").rstrip("/")
 TOKEN = os.getenv("PM_ADMIN_TOKEN")
 JOB = sys.argv[1]
+POLL_SECS = float(os.getenv("PM_JOB_POLL_SECS", "2"))
+POLL_TIMEOUT_SECS = float(os.getenv("PM_JOB_TIMEOUT_SECS", "600"))
 
 def wait_for_health():
     for _ in range(15):
@@ -29,4 +31,25 @@ r = requests.post(
 )
 
 print(r.status_code, r.text)
-r.raise_for_status()
\ No newline at end of file
+r.raise_for_status()
+
+# Jobs run in the background; poll until the job row is finished
+job_id = r.json()["job_id"]
+deadline = time.time() + POLL_TIMEOUT_SECS
+while True:
+    r = requests.get(
+        f"{API}/v1/admin/jobs/{job_id}",
+        headers={"x-admin-token": TOKEN},
+        timeout=30,
+    )
+    r.raise_for_status()
+    job = r.json()
+    if job["status"] != "running":
+        break
+    if time.time() > deadline:
+        raise SystemExit(f"job {job_id} still running after {POLL_TIMEOUT_SECS}s")
+    time.sleep(POLL_SECS)
+
+print(job["status"], job["result"])
+if job["status"] != "done":
+    raise SystemExit(f"job {job_id} {job['status']}")
\ No newline at end of file